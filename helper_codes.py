@@ -6,6 +6,10 @@ Created on Thu May  5 10:06:39 2022
 This script includes:
     – a function to be called in parallel for the second
     stage of processing records in OptionMetrics dataset. 
+    – functions to process all horizons of a year from one return panel.
+    – a function to process a stratified sample of records for a quick look.
+    – a function to aggregate buy/sell-side statistics by calendar
+    period (year, quarter, month or week) in one grouped pass.
 
 Common disclaimers apply.
 
@@ -19,34 +23,57 @@ import numpy as np
 from datetime import datetime,timedelta
 from os.path import isfile
 import warnings
+from statistics import NormalDist
 warnings.filterwarnings("ignore")
 
 
 
-def gen_db(year_sel,progress_step=100,horizon=60):
+def load_crsp(year_sel,horizon=60):
+    '''Returns the _crsp.csv table for year_sel and the records of the 
+    neighbouring years needed for the historical and forward windows.'''
     months_horizon=horizon//30
     months_horizon=months_horizon%12
     yr_horizon=horizon//365
+    db_col_all=pd.DataFrame()
+    fl_lbl_crsp_last='Study_table_'+str(year_sel-1)+'_'+str(horizon)+'_crsp.csv'
+    fl_lbl_crsp='Study_table_'+str(year_sel)+'_'+str(horizon)+'_crsp.csv'
+    fl_lbl_crsp_next='Study_table_'+str(year_sel+1)+'_'+str(horizon)+'_crsp.csv'
+    study_tbl_last=pd.read_csv(fl_lbl_crsp_last)
+    db_col_all=db_col_all.append(study_tbl_last)
+    study_tbl=pd.read_csv(fl_lbl_crsp)  # This is the main table
+    db_col_all=db_col_all.append(study_tbl)
+    study_tbl['date']=pd.to_datetime(study_tbl['date'])
+    study_tbl_next=pd.read_csv(fl_lbl_crsp_next)
+    db_col_all=db_col_all.append(study_tbl_next)
+    if type(db_col_all.iloc[0,2])==str:
+        db_col_all['date']=pd.to_datetime(db_col_all['date'])
+    db_col=db_col_all[(db_col_all['date']>=pd.Timestamp(year_sel-yr_horizon-1, 12-months_horizon-1, 1))]
+    db_col=db_col[(db_col['date']<pd.Timestamp(year_sel+yr_horizon+1, months_horizon+1, 1))]
+    db_col=db_col.reset_index(drop=True)
+    db_col=db_col.sort_values(by=['date','secid'])
+    return study_tbl,db_col
+
+def rv_row(db_col,sel_asset,sel_date,horizon=60):
+    '''Returns the historical and forward realised volatility and the closing
+    price at expiry for one record. Each trading day of the security counts
+    once in a window, whatever the number of contracts quoted on it.'''
+    hist_start=sel_date-timedelta(days=horizon)
+    forward_date=sel_date+timedelta(days=horizon)
+    mini_tbl=db_col[db_col.secid==sel_asset].drop_duplicates(subset='date')
+    hist_cond=np.logical_and(mini_tbl.date>=hist_start,mini_tbl.date<sel_date)
+    ret_ser_hist=mini_tbl['return'][hist_cond].values
+    rv_d_hist=np.power(np.sum(np.power(ret_ser_hist,2))*252/ret_ser_hist.shape[0],.5)
+    forward_cond=np.logical_and(mini_tbl.date<forward_date,mini_tbl.date>=sel_date)
+    ret_ser_forward=mini_tbl['return'][forward_cond].values
+    rv_d_forward=np.power(np.sum(np.power(ret_ser_forward,2))*252/ret_ser_forward.shape[0],.5)
+    real_forward_price=mini_tbl['close'][forward_cond].values[-1]
+    return rv_d_hist,rv_d_forward,real_forward_price
+
+def gen_db(year_sel,progress_step=100,horizon=60):
     flname='Study_table_'+str(year_sel)+'_'+str(horizon)+'_proc.csv'
     if isfile(flname)==False:
-        db_col_all=pd.DataFrame()
         print('data processing started for year '+str(year_sel))
-        fl_lbl_crsp_last='Study_table_'+str(year_sel-1)+'_'+str(horizon)+'_crsp.csv'
-        fl_lbl_crsp='Study_table_'+str(year_sel)+'_'+str(horizon)+'_crsp.csv'
-        fl_lbl_crsp_next='Study_table_'+str(year_sel+1)+'_'+str(horizon)+'_crsp.csv'
-        study_tbl_last=pd.read_csv(fl_lbl_crsp_last)
-        db_col_all=db_col_all.append(study_tbl_last)
-        study_tbl=pd.read_csv(fl_lbl_crsp)  # This is the main table
-        db_col_all=db_col_all.append(study_tbl)
-        study_tbl['date']=pd.to_datetime(study_tbl['date'])
-        study_tbl_next=pd.read_csv(fl_lbl_crsp_next)
-        db_col_all=db_col_all.append(study_tbl_next)
-        if type(db_col_all.iloc[0,2])==str:
-            db_col_all['date']=pd.to_datetime(db_col_all['date'])
-        db_col=db_col_all[(db_col_all['date']>=pd.Timestamp(year_sel-yr_horizon-1, 12-months_horizon-1, 1))]
-        db_col=db_col[(db_col['date']<pd.Timestamp(year_sel+yr_horizon+1, months_horizon+1, 1))]
-        db_col=db_col.reset_index(drop=True)
-        db_col=db_col.sort_values(by=['date','secid'])
+        study_tbl,db_col=load_crsp(year_sel,horizon)
         
         rv_d_hist=pd.Series(index=study_tbl.index)
         rv_d_forward=pd.Series(index=study_tbl.index)
@@ -55,24 +82,8 @@ def gen_db(year_sel,progress_step=100,horizon=60):
         progress_size=count_iter//progress_step
         t21=datetime.now()
         for s in range(study_tbl.index[0],study_tbl.index[-1]):
-            sel_asset=int(study_tbl['secid'][s])
-            sel_date=study_tbl.date[s]
-            cp_flag=study_tbl.cp_flag[s]
-            hist_start=sel_date-timedelta(days=horizon)
-            forward_date=sel_date+timedelta(days=horizon)
-            mini_tbl=db_col[db_col.secid==sel_asset]
-            hist_cond=np.logical_and(mini_tbl.secid==sel_asset,
-                                     np.logical_and(mini_tbl.date>=hist_start,
-                                                    np.logical_and(mini_tbl.date<sel_date,mini_tbl.cp_flag==cp_flag)))
-            
-            ret_ser_hist=np.unique(mini_tbl['return'][hist_cond])
-            rv_d_hist[s]=np.power(np.sum(np.power(ret_ser_hist,2))*252/ret_ser_hist.shape[0],.5)
-            forward_cond=np.logical_and(mini_tbl.secid==sel_asset,
-                                     np.logical_and(mini_tbl.date<forward_date,
-                                                    np.logical_and(mini_tbl.date>=sel_date,mini_tbl.cp_flag==cp_flag)))
-            ret_ser_forward=np.unique(mini_tbl['return'][forward_cond])
-            rv_d_forward[s]=np.power(np.sum(np.power(ret_ser_forward,2))*252/ret_ser_forward.shape[0],.5)
-            real_forward_price[s]=mini_tbl['close'][forward_cond].values[-1]
+            rv_d_hist[s],rv_d_forward[s],real_forward_price[s]=rv_row(
+                db_col,int(study_tbl['secid'][s]),study_tbl.date[s],horizon)
             
             if (s-study_tbl.index[0]+1)%progress_size==0:
                 t22=datetime.now()
@@ -90,3 +101,229 @@ def gen_db(year_sel,progress_step=100,horizon=60):
     else:
         print('Processed OptionMetrics dataset exists for year '+str(year_sel))
 
+def gen_db_sample(year_sel,frac=0.05,progress_step=100,horizon=60,seed=0):
+    '''Approximate version of gen_db. Records of year_sel are stratified by 
+    (secid, cp_flag) and a fraction frac of each stratum (at least one record) 
+    is drawn at random. The realised volatility columns are computed for the 
+    drawn records only, each weighted by the inverse of its sampling rate.
+    The sample is stored per frac and seed.'''
+    flname='Study_table_'+str(year_sel)+'_'+str(horizon)+'_sample'+str(frac)+'_'+str(seed)+'.csv'
+    if isfile(flname)==False:
+        print('sampled data processing started for year '+str(year_sel))
+        study_tbl,db_col=load_crsp(year_sel,horizon)
+        
+        rng=np.random.default_rng(seed+year_sel)
+        strata=[study_tbl.secid,study_tbl.cp_flag]
+        draw_rank=pd.Series(rng.random(study_tbl.shape[0]),
+                            index=study_tbl.index).groupby(strata).rank(method='first')
+        stratum_size=study_tbl.groupby(strata)['secid'].transform('size')
+        sample_size=np.ceil(stratum_size*frac)
+        is_drawn=draw_rank<=sample_size
+        sample_tbl=study_tbl[is_drawn].copy()
+        sample_tbl['weight']=(stratum_size/sample_size)[is_drawn]
+        
+        rv_d_hist=pd.Series(index=sample_tbl.index)
+        rv_d_forward=pd.Series(index=sample_tbl.index)
+        real_forward_price=pd.Series(index=sample_tbl.index)
+        progress_size=max(sample_tbl.shape[0]//progress_step,1)
+        t21=datetime.now()
+        for count_s,s in enumerate(sample_tbl.index):
+            rv_d_hist[s],rv_d_forward[s],real_forward_price[s]=rv_row(
+                db_col,int(sample_tbl['secid'][s]),sample_tbl.date[s],horizon)
+            
+            if (count_s+1)%progress_size==0:
+                t22=datetime.now()
+                dt2=t22-t21
+                progress_made=(count_s+1)//progress_size
+                print(str(progress_made)+'% completed after '+
+                      str(dt2.seconds)+ ' seconds for sampled year '+str(year_sel))
+        sample_tbl['rv_d_hist']=rv_d_hist
+        sample_tbl['rv_d_forward']=rv_d_forward
+        sample_tbl['real_forward_price']=real_forward_price
+        sample_tbl=sample_tbl.sort_values(by=['date','secid'])
+        sample_tbl=sample_tbl[pd.isna(sample_tbl.rv_d_hist)==False]
+        
+        sample_tbl.to_csv(flname,index=False)
+    else:
+        print('Sampled OptionMetrics dataset exists for year '+str(year_sel))
+
+
+key_step=10**6  # days per security in the keys of the return panel
+
+def ret_panel(crsp_list):
+    '''Builds the daily return panel of all securities in the tables of 
+    crsp_list: one record per security and trading day, keyed by security then
+    date, with the prefix sums of squared returns.'''
+    panel_tbl=pd.concat([crsp_tbl[['secid','date','return','close']] for crsp_tbl in crsp_list],
+                        ignore_index=True)
+    panel_tbl=panel_tbl.drop_duplicates(subset=['secid','date'])
+    panel_tbl=panel_tbl.sort_values(by=['secid','date'],ignore_index=True)
+    secid_list=np.unique(panel_tbl['secid'].values)
+    code=np.searchsorted(secid_list,panel_tbl['secid'].values).astype(np.int64)
+    day=panel_tbl['date'].values.astype('datetime64[D]').astype(np.int64)
+    ret=panel_tbl['return'].values
+    panel={'secid_list':secid_list,
+           'key':code*key_step+day,
+           'cum_ret':np.concatenate([[0],np.cumsum(np.power(np.nan_to_num(ret),2))]),
+           'cum_nan':np.concatenate([[0],np.cumsum(np.isnan(ret))]),
+           'close':panel_tbl['close'].values}
+    return panel
+
+def rv_panel(panel,secid,date,horizon):
+    '''Returns the historical and forward realised volatility and the closing
+    price at expiry for the records (secid, date) from the return panel. 
+    Windows are located by binary search so every record costs O(log n) 
+    whatever the horizon.'''
+    key=panel['key']
+    cum_ret=panel['cum_ret']
+    cum_nan=panel['cum_nan']
+    sel_key=np.searchsorted(panel['secid_list'],secid).astype(np.int64)*key_step+\
+        np.asarray(date,dtype='datetime64[D]').astype(np.int64)
+    hist_lo=np.searchsorted(key,sel_key-horizon,side='left')
+    mid=np.searchsorted(key,sel_key,side='left')
+    forward_hi=np.searchsorted(key,sel_key+horizon,side='left')
+    def _rv(lo,hi):
+        count_ret=hi-lo
+        rv=np.power((cum_ret[hi]-cum_ret[lo])*252/np.maximum(count_ret,1),.5)
+        rv[(count_ret==0)|(cum_nan[hi]-cum_nan[lo]>0)]=np.nan
+        return rv
+    rv_d_hist=_rv(hist_lo,mid)
+    rv_d_forward=_rv(mid,forward_hi)
+    real_forward_price=np.where(forward_hi>mid,
+                                panel['close'][np.maximum(forward_hi-1,0)],np.nan)
+    return rv_d_hist,rv_d_forward,real_forward_price
+
+def gen_db_multi(year_sel,horizons=[30,60,91,182,365]):
+    '''Processes year_sel for all horizons together. The daily returns of 
+    every security are read once from the _crsp.csv tables of all horizons
+    and the prefix sums of squared returns are shared by all horizons.'''
+    horizons=[h for h in horizons if isfile('Study_table_'+str(year_sel)+'_'+
+                                            str(h)+'_proc.csv')==False]
+    if len(horizons)==0:
+        print('Processed OptionMetrics datasets exist for year '+str(year_sel))
+        return
+    print('multi-horizon data processing started for year '+str(year_sel))
+    t21=datetime.now()
+    study_list=[]
+    crsp_list=[]
+    for horizon in horizons:
+        for year_crsp in [year_sel-1,year_sel,year_sel+1]:
+            fl_lbl_crsp='Study_table_'+str(year_crsp)+'_'+str(horizon)+'_crsp.csv'
+            crsp_tbl=pd.read_csv(fl_lbl_crsp,parse_dates=['date'])
+            crsp_list.append(crsp_tbl)
+            if year_crsp==year_sel:
+                study_list.append(crsp_tbl)
+    panel=ret_panel(crsp_list)
+    t22=datetime.now()
+    dt2=t22-t21
+    print('return panel built after '+str(dt2.seconds)+' seconds for year '+str(year_sel))
+    
+    for horizon,study_tbl in zip(horizons,study_list):
+        flname='Study_table_'+str(year_sel)+'_'+str(horizon)+'_proc.csv'
+        rv_d_hist,rv_d_forward,real_forward_price=rv_panel(
+            panel,study_tbl['secid'].values,study_tbl['date'].values,horizon)
+        study_tbl['rv_d_hist']=rv_d_hist
+        study_tbl['rv_d_forward']=rv_d_forward
+        study_tbl['real_forward_price']=real_forward_price
+        study_tbl=study_tbl.sort_values(by=['date','secid'])
+        study_tbl=study_tbl[pd.isna(study_tbl.rv_d_hist)==False]
+        
+        study_tbl.to_csv(flname,index=False)
+        t22=datetime.now()
+        dt2=t22-t21
+        print('horizon '+str(horizon)+' completed after '+
+              str(dt2.seconds)+' seconds for year '+str(year_sel))
+
+
+freq_choices=['Y','Q','M','W']
+
+def agg_stats(db_top,freq='Y',conf=None):
+    '''Aggregates the buy/sell-side statistics of the contracts in db_top
+    (with profit and %profit columns) by calendar period and option type.
+    All statistics are formed from one groupby over (period, cp_flag, secid). 
+    Records are weighted by the weight column if present (see gen_db_sample).
+    With conf (e.g. 0.95) the analytic confidence interval of each statistic, 
+    clustered by firm, is added in the lower and upper columns next to it.
+    Returns a DataFrame with one row per period. '''
+    if freq not in freq_choices:
+        raise ValueError('freq must be one of '+', '.join(freq_choices))
+    db_grp=pd.DataFrame(index=db_top.index)
+    db_grp['forward/hist']=db_top.rv_d_forward/db_top.rv_d_hist
+    db_grp['implied/hist']=db_top.impl_volatility/db_top.rv_d_hist
+    db_grp['forward/implied']=db_top.rv_d_forward/db_top.impl_volatility
+    db_grp['%gain']=db_top['%profit']
+    db_grp['in-money ratio']=(db_top.profit>0).astype(float)
+    db_grp['in-money gain']=db_top['%profit'].where(db_top.profit>0)
+    db_grp['out-money ratio']=(db_top.profit<0).astype(float)
+    db_grp['out-money gain']=db_top['%profit'].where(db_top.profit<0)
+    if 'weight' in db_top.columns:
+        weight=db_top['weight']
+    else:
+        weight=pd.Series(1.0,index=db_top.index)
+    
+    # Weighted sums of every statistic by firm, the stratum of gen_db_sample
+    part_tbl=pd.concat({'count':weight.to_frame('count'),
+                        'w':db_grp.notna().mul(weight,axis=0),
+                        'wx':db_grp.fillna(0).mul(weight,axis=0)},axis=1)
+    period=pd.to_datetime(db_top['date']).dt.to_period(freq).rename('period')
+    firm_tbl=part_tbl.groupby([period,db_top['cp_flag'],db_top['secid']]).sum()
+    
+    def _mean_se(level_list):
+        # Ratio mean over the firms of each group, with the variance of the
+        # firm totals (clustered by firm, as records of a firm are correlated)
+        sum_tbl=firm_tbl.groupby(level=level_list).sum()
+        mean_tbl=sum_tbl['wx']/sum_tbl['w']
+        if conf==None:
+            return sum_tbl,mean_tbl,None
+        drop_list=[lvl for lvl in firm_tbl.index.names if lvl not in level_list]
+        mean_firm=mean_tbl.reindex(firm_tbl.index.droplevel(drop_list)).values
+        resid=firm_tbl['wx']-firm_tbl['w']*mean_firm
+        count_firm=(firm_tbl['w']>0).groupby(level=level_list).sum()
+        var_tbl=np.power(resid,2).groupby(level=level_list).sum()*\
+            count_firm/(count_firm-1)
+        se_tbl=np.power(var_tbl,.5)/sum_tbl['w']
+        return sum_tbl,mean_tbl,se_tbl
+    sum_tbl,mean_tbl,se_tbl=_mean_se(['period','cp_flag'])
+    # forward/hist is averaged over both calls and puts in each period
+    _,mean_all,se_all=_mean_se(['period'])
+    mean_tbl=mean_tbl.unstack('cp_flag')
+    
+    result_tbl=pd.DataFrame(index=mean_tbl.index)
+    count_call=sum_tbl[('count','count')].unstack('cp_flag')['C'].fillna(0)
+    result_tbl['count p/c']=np.round(count_call).astype(int)
+    if conf!=None:
+        se_tbl=se_tbl.unstack('cp_flag')
+        se_all=se_all['forward/hist']
+    stat_list=[('forward/hist vol',mean_all['forward/hist'],se_all)]
+    for flag in ['C','P']:
+        lbl=flag.lower()+' '
+        for col,stat in [('implied/hist vol','implied/hist'),
+                         ('implied/forward vol','forward/implied'),
+                         ('%gain','%gain'),
+                         ('in-money ratio','in-money ratio'),
+                         ('in-money gain','in-money gain'),
+                         ('out-money ratio','out-money ratio'),
+                         ('out-money gain','out-money gain')]:
+            se_sel=None if conf==None else se_tbl[(stat,flag)]
+            stat_list.append((lbl+col,mean_tbl[(stat,flag)],se_sel))
+    
+    if conf!=None:
+        z_score=NormalDist().inv_cdf(.5+conf/2)
+    for col,mean_sel,se_sel in stat_list:
+        lower=None if conf==None else mean_sel-z_score*se_sel
+        upper=None if conf==None else mean_sel+z_score*se_sel
+        if col.endswith('implied/forward vol'):
+            # Reported as the inverse of the average forward/implied vol
+            mean_sel=np.power(mean_sel,-1)
+            lower,upper=(None,None) if conf==None else (np.power(upper,-1),np.power(lower,-1))
+        result_tbl[col]=mean_sel
+        if conf!=None:
+            result_tbl[col+' lower']=lower
+            result_tbl[col+' upper']=upper
+    
+    if freq=='Y':
+        result_tbl.insert(0,'year',result_tbl.index.year)
+    else:
+        result_tbl.insert(0,'period',result_tbl.index.to_timestamp())
+    result_tbl=result_tbl.reset_index(drop=True)
+    return result_tbl
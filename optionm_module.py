@@ -17,11 +17,14 @@ import numpy as np
 from datetime import datetime,timedelta
 from os.path import isfile
 import wrds
+import threading
 from multiprocessing import Pool
 import matplotlib.pyplot as plt
 from statsmodels.stats.weightstats import ttest_ind
-from helper_codes import gen_db
+from helper_codes import gen_db,gen_db_multi,gen_db_sample,agg_stats,freq_choices
 from functools import partial
+from surface import stream_month,load_surface,surface_file,surface_lookup
+from panel_stats import panel_tests,se_choices,block_bootstrap,boot_choices,join_ci
 global gen_db
 
 class OptionM:
@@ -30,7 +33,7 @@ class OptionM:
     – horizon: number of calendar days to maturity of options (default=91)
     – progress: used for step-size progress report (default=100)
 
-    This module has four methods:
+    This module has the following methods:
     
     – step1_crsp(): This procedure retrieves data from OptionMetrics and match records with CRSP. 
     The matching is done using 8-char CUSIP numbers. The selected records are US 
@@ -39,6 +42,12 @@ class OptionM:
     (100 shares) with  10, 30, 60, 91, 122, 152, 182, 273, 365, 547 and 730 
      days maturity is recorded.
      
+    – step1_surface(): This procedure retrieves the listed option contracts 
+    (optionm.opprcd) across strikes and maturities for CRSP-matched stocks, 
+    filtered by moneyness and days to expiry in the query, into monthly 
+    partitions. surface() loads a month indexed by (secid, date, exdate) and
+    surface_lookup() selects contracts from the partition of their date.
+     
     – step2_proc(): This procedure adds three columns to the OptionMetrics dataset:
         * rv_d_hist:          d-day  historical realised volatility 
            calculated as sum of squared daily close-to-close returns
@@ -48,6 +57,8 @@ class OptionM:
             from date of record to d days after the date.  
         * real_forward_price: Closing price at the expiry date of the option
         d can be selected from 10, 30, 60, 91, 122, 152, 182, 273, 365, 547 and 730 
+        With horizons (e.g. [30, 91, 182]) all listed horizons are processed 
+        together from the prefix sums of one daily return panel per year.
         
     – step3_buy(): This procedure compares for top 100 stocks by Market Cap in each year
     degree to which stardard call and put options are gainful. The script links 
@@ -62,9 +73,22 @@ class OptionM:
     descriptive stats. 
     All analysis are done for a sell-side interested in hedging/speculating by 
     selling call/put options.
+    
+    – quick_look(): Approximate buy- or sell-side analysis on a stratified
+    sample of records with confidence intervals, for triage before step2_proc().
+    
+    – analyse_panel(): Per-firm and/or per-year tests of call/put gains and
+    implied/realised vol ratios with iid, Newey-West or clustered errors.
+    
+    Both analysis methods accept freq ('Y', 'Q', 'M' or 'W') to report the 
+    statistics by calendar year (default), quarter, month or week. 
+    With boot (number of draws) they add block-bootstrap confidence intervals
+    for every gain column and the annualised gains (block length block, 
+    'moving' or 'stationary' boot_method).
 
     '''
     db=wrds.Connection()
+    db_lock=threading.Lock()  # WRDS connection is shared by pipeline threads
     print('Connection established to WRDS ...')
     now=datetime.now()
     __version__='1.0.5'
@@ -117,6 +141,20 @@ class OptionM:
         else:
             self.h=horizon
         
+        matched_cusip_list=None
+        for year_sel in range(study_period[0]-1,study_period[-1]+2):
+            fl_lbl_crsp='Study_table_'+str(year_sel)+'_'+str(horizon)+'_crsp.csv'
+            if isfile(fl_lbl_crsp)==False:
+                if matched_cusip_list==None:
+                    matched_cusip_list=self.match_crsp()
+                self.crsp_year(year_sel,horizon,matched_cusip_list)
+            else:
+                print('Matched OptionMetrics-CRSP dataset exists for year '+str(year_sel))
+    # END OF FIRST PROCEDURE
+    
+    def match_crsp(self):
+        '''Returns the list of 8-char CUSIPs in OptionMetrics matched with 
+        CRSP common stocks.'''
         db=self.db
         
         #optionm_description=db.describe_table('optionm', table='secnmd')
@@ -179,8 +217,13 @@ class OptionM:
         matched_cusip=matched_cusip.reset_index(drop=True)
         matched_cusip_list=matched_cusip.cusip8.to_list()
         print('Successfully identified matched CUSIP-CRSP data ...')
+        return matched_cusip_list
 
-
+    def crsp_year(self,year_sel,horizon,matched_cusip_list):
+        '''Retrieves the OptionMetrics records of year_sel for the given horizon,
+        keeps the contracts matched with CRSP and stores them in the _crsp.csv file.'''
+        db=self.db
+        fl_lbl_crsp='Study_table_'+str(year_sel)+'_'+str(horizon)+'_crsp.csv'
         sql_query="""SELECT DISTINCT stdopd1996.secid,                  
         	secnmd.cusip,
             stdopd1996.date,                         
@@ -209,44 +252,74 @@ class OptionM:
         sql_query=sql_query.replace('XX',str(horizon))
 
 
-        for year_sel in range(study_period[0]-1,study_period[-1]+2):
-            fl_lbl_crsp='Study_table_'+str(year_sel)+'_'+str(horizon)+'_crsp.csv'
-            if isfile(fl_lbl_crsp)==False:
-                print('data collection started for year '+str(year_sel))
-                t0=datetime.now()
-                sql_query_sel=sql_query.replace('1996',str(year_sel))
-                op_table=db.raw_sql(sql_query_sel,date_cols=['date'])
-                op_table=op_table.reset_index(drop=True)
-                t1=datetime.now()
-                dt=t1-t0
-                print('data collection completed for '+str(year_sel)+' after '+str(dt.seconds)+ ' seconds')
-                
-                included_crsp=np.zeros_like(op_table.index)
-                t0=datetime.now()
-                print('Identifying derivatives on CRSP for year '+str(year_sel)+' ...')
-                
-                # for s in op_table.index:
-                #     if op_table.cusip[s] in matched_cusip_list:
-                #         included_crsp[s]=1
-                #     else:
-                #         included_crsp[s]=0
-                
-                included_crsp=[(op_table.cusip[s] in matched_cusip_list) for s in 
-                               op_table.index]
-                op_table['included_crsp']=included_crsp
-                op_table=op_table[op_table.included_crsp==1]
-                op_table=op_table.drop(columns='included_crsp')
-                op_table=op_table.sort_values(by=['secid','date'])
-                t1=datetime.now()            
-                dt=t1-t0
-                print('Matching derivatives with CRSP completed after '+str(dt.total_seconds()
-                                                                            )+' secs')
-                op_table.to_csv(fl_lbl_crsp,index=False)
-            else:
-                print('Matched OptionMetrics-CRSP dataset exists for year '+str(year_sel))
-    # END OF FIRST PROCEDURE
+        print('data collection started for year '+str(year_sel))
+        t0=datetime.now()
+        sql_query_sel=sql_query.replace('1996',str(year_sel))
+        with self.db_lock:
+            op_table=db.raw_sql(sql_query_sel,date_cols=['date'])
+        op_table=op_table.reset_index(drop=True)
+        t1=datetime.now()
+        dt=t1-t0
+        print('data collection completed for '+str(year_sel)+' after '+str(dt.seconds)+ ' seconds')
+
+        included_crsp=np.zeros_like(op_table.index)
+        t0=datetime.now()
+        print('Identifying derivatives on CRSP for year '+str(year_sel)+' ...')
+
+        # for s in op_table.index:
+        #     if op_table.cusip[s] in matched_cusip_list:
+        #         included_crsp[s]=1
+        #     else:
+        #         included_crsp[s]=0
+
+        included_crsp=[(op_table.cusip[s] in matched_cusip_list) for s in 
+                       op_table.index]
+        op_table['included_crsp']=included_crsp
+        op_table=op_table[op_table.included_crsp==1]
+        op_table=op_table.drop(columns='included_crsp')
+        op_table=op_table.sort_values(by=['secid','date'])
+        t1=datetime.now()            
+        dt=t1-t0
+        print('Matching derivatives with CRSP completed after '+str(dt.total_seconds()
+                                                                    )+' secs')
+        op_table.to_csv(fl_lbl_crsp,index=False)
+
     
-    def step2_proc(self,study_period=None,horizon=None,progress_step=None):
+    def step1_surface(self,study_period=None,moneyness=(0.8,1.2),maturity=(7,365),
+                      chunksize=500000):
+        '''Retrieves the listed options (optionm.opprcd) on CRSP-matched stocks
+        with strike/close within moneyness and days to expiry within maturity.
+        The filters run in the WRDS query and the records are streamed in
+        chunks into one Surface_table_YYYY_MM.csv partition per month.'''
+        if study_period==None:
+            study_period=self.s
+        else:
+            self.s=study_period
+        
+        matched_cusip_list=None
+        for year_sel in study_period:
+            print('Option surface collection started for year '+str(year_sel))
+            for month_sel in range(1,13):
+                if isfile(surface_file(year_sel,month_sel)):
+                    print('Option surface partition exists for '+str(year_sel)+'-'+
+                          str(month_sel).zfill(2))
+                    continue
+                if matched_cusip_list==None:
+                    matched_cusip_list=self.match_crsp()
+                stream_month(self.db,year_sel,month_sel,matched_cusip_list,
+                             moneyness=moneyness,maturity=maturity,chunksize=chunksize)
+    
+    def surface(self,year_sel,month_sel):
+        '''Returns the option surface of month_sel in year_sel indexed by 
+        (secid, date, exdate).'''
+        return load_surface(year_sel,month_sel)
+    
+    def surface_lookup(self,secid,date,exdate=None):
+        '''Returns the contracts of secid quoted on date (and expiring on 
+        exdate if given) from the monthly partition of date.'''
+        return surface_lookup(secid,date,exdate)
+
+    def step2_proc(self,study_period=None,horizon=None,progress_step=None,horizons=None):
         if study_period==None:
             study_period=self.s
         else:
@@ -263,12 +336,76 @@ class OptionM:
             self.p=progress_step
         
         p=Pool()
-        p.map(partial(gen_db,progress_step=progress_step,horizon=horizon),study_period)
+        if horizons==None:
+            p.map(partial(gen_db,progress_step=progress_step,horizon=horizon),study_period)
+        else:
+            # All horizons from one return panel per year
+            p.map(partial(gen_db_multi,horizons=horizons),study_period)
         p.terminate()
 
             
+    def top_year(self,year_sel,market_cap_count=100,horizon=None,side='buy',table='proc'):
+        '''Returns the processed records of year_sel for the top market_cap_count
+        firms by Market Cap with the buy- or sell-side profit of each contract.
+        table selects the processed dataset ('proc' or 'sample<frac>_<seed>').
+        Returns None if the processed dataset for year_sel is missing.'''
+        db=self.db
+        if horizon==None:
+            horizon=self.h
+
+        sql_query_init="""select dsf.cusip, dsf.permno, dsf.date, dsf.prc, dsf.shrout,
+        dsfhdr.hshrcd, dsfhdr.htick, dsfhdr.hcomnam from crsp.dsf join crsp.dsfhdr on dsfhdr.cusip=dsf.cusip
+        where date='1995-12-31' and dsf.hexcd>=1 and dsf.hexcd<=3 and dsfhdr.hshrcd>=10
+        and dsfhdr.hshrcd<=11"""
+
+        flname='Study_table_'+str(year_sel)+'_'+str(horizon)+'_'+table+'.csv'
+        if isfile(flname)==False:
+            return None
+        proc_db=pd.read_csv(flname)
+        #db.describe_table('crsp', 'dsfhdr')
+        with self.db_lock:
+            crs_tbl=db.raw_sql(sql_query_init)
+        day_back=0
+        while crs_tbl.shape[0]==0:
+            day_back-=1
+            last_date_trading=datetime(year=year_sel,month=1,day=1)+timedelta(days=day_back)
+            last_date_trading.strftime('%Y-%m-%d')
+            new_sql_query=sql_query_init.replace('1995-12-31',
+                                                 last_date_trading.strftime('%Y-%m-%d'))
+
+            with self.db_lock:
+                crs_tbl=db.raw_sql(new_sql_query)
+        crs_tbl['mkval']=crs_tbl.prc*crs_tbl.shrout
+        crs_tbl=crs_tbl.sort_values(by='mkval',ascending=False,ignore_index=True)
+        top_mkcap_cusip=crs_tbl.cusip[0:market_cap_count].values
+        db_top=pd.DataFrame()
+        for cusip_top in top_mkcap_cusip:
+            proc_db_sel=proc_db[proc_db.cusip.values==cusip_top]
+            if proc_db_sel.shape[0]>0:
+                db_top=db_top.append(proc_db_sel)
+        db_top=db_top.drop(db_top[db_top.rv_d_hist==0].index)
+        db_top=db_top.reset_index(drop=True)
+
+        if side=='buy':
+            db_top['profit']=(db_top.cp_flag=='C').astype(int)*\
+                (db_top.real_forward_price-db_top.forward_price-db_top.premium)+\
+                    (db_top.cp_flag=='P').astype(int)*\
+                        (db_top.forward_price-db_top.real_forward_price-db_top.premium)
+            db_top['profit'][db_top['profit']<=-1*db_top['premium']]=\
+                -1*db_top['premium'][db_top['profit']<=-1*db_top['premium']]
+        else:
+            db_top['profit']=(db_top.cp_flag=='C').astype(int)*\
+                (db_top.premium+db_top.forward_price-db_top.real_forward_price)+\
+                    (db_top.cp_flag=='P').astype(int)*\
+                        (db_top.premium+db_top.real_forward_price-db_top.forward_price)
+            db_top['profit'][db_top['profit']>=db_top['premium']]=\
+                db_top['premium'][db_top['profit']>=db_top['premium']]
+        db_top['%profit']=db_top['profit']/db_top['forward_price']
+        return db_top
+
     # END OF SECOND PROCEDURE
-    def analyse_buy(self,market_cap_count=100,horizon=None,study_period=None):
+    def analyse_buy(self,market_cap_count=100,horizon=None,study_period=None,freq='Y',
+                    boot=None,block=None,boot_method='moving',conf=0.95):
         db=self.db        
         if type(horizon)!=int:
             horizon=self.h
@@ -279,174 +416,51 @@ class OptionM:
             study_period=self.s
         else:
             self.s=study_period
-            
-        sql_query_init="""select dsf.cusip, dsf.permno, dsf.date, dsf.prc, dsf.shrout,
-        dsfhdr.hshrcd, dsfhdr.htick, dsfhdr.hcomnam from crsp.dsf join crsp.dsfhdr on dsfhdr.cusip=dsf.cusip
-        where date='1995-12-31' and dsf.hexcd>=1 and dsf.hexcd<=3 and dsfhdr.hshrcd>=10
-        and dsfhdr.hshrcd<=11"""
         
+        if freq not in freq_choices:
+            raise ValueError('freq must be one of '+', '.join(freq_choices))
+        if boot_method not in boot_choices:
+            raise ValueError('boot_method must be one of '+', '.join(boot_choices))
+            
         print('Top '+str(market_cap_count)+' US firms by Market Cap are studied between '+
               str(study_period[0])+' - '+str(study_period[-1]))
-        count_call=[]
-        forward_to_hist_ratio=[]
-        call_imp_to_hist_ratio=[]
-        call_forward_to_imp=[]
-        call_gain_mu=[]
-        call_in_money_ratio=[]
-        call_at_money_ratio=[]
-        call_out_money_ratio=[]
-
-        call_in_money_mu=[]
-        call_out_money_mu=[]
-
-        put_imp_to_hist_ratio=[]
-        put_forward_to_imp=[]
-
-        put_gain_mu=[]
-        put_in_money_ratio=[]
-        put_at_money_ratio=[]
-        put_out_money_ratio=[]
-
-        put_in_money_mu=[]
-        put_out_money_mu=[]
+        db_list=[]
 
         for year_sel in study_period:
-            flname='Study_table_'+str(year_sel)+'_'+str(horizon)+'_proc.csv'
-            if isfile(flname):
-                proc_db=pd.read_csv(flname)
-                #db.describe_table('crsp', 'dsfhdr')
-                crs_tbl=db.raw_sql(sql_query_init)
-                day_back=0
-                while crs_tbl.shape[0]==0:
-                    day_back-=1
-                    last_date_trading=datetime(year=year_sel,month=1,day=1)+timedelta(days=day_back)
-                    last_date_trading.strftime('%Y-%m-%d')
-                    new_sql_query=sql_query_init.replace('1995-12-31',
-                                                         last_date_trading.strftime('%Y-%m-%d'))
-                    
-                    crs_tbl=db.raw_sql(new_sql_query)
-                crs_tbl['mkval']=crs_tbl.prc*crs_tbl.shrout
-                crs_tbl=crs_tbl.sort_values(by='mkval',ascending=False,ignore_index=True)
-                top_mkcap_cusip=crs_tbl.cusip[0:market_cap_count].values
-                db_top=pd.DataFrame()
-                for cusip_top in top_mkcap_cusip:
-                    proc_db_sel=proc_db[proc_db.cusip.values==cusip_top]
-                    if proc_db_sel.shape[0]>0:
-                        db_top=db_top.append(proc_db_sel)
-                db_top=db_top.drop(db_top[db_top.rv_d_hist==0].index)
-                db_top=db_top.reset_index(drop=True)
-                
-                db_top['profit']=(db_top.cp_flag=='C').astype(int)*\
-                    (db_top.real_forward_price-db_top.forward_price-db_top.premium)+\
-                        (db_top.cp_flag=='P').astype(int)*\
-                            (db_top.forward_price-db_top.real_forward_price-db_top.premium)
-                db_top['profit'][db_top['profit']<=-1*db_top['premium']]=\
-                    -1*db_top['premium'][db_top['profit']<=-1*db_top['premium']]
-                db_top['%profit']=db_top['profit']/db_top['forward_price']
-                call_tbl=db_top[db_top.cp_flag=='C']
-                count_trading_days=np.unique(call_tbl.date).shape[0]
-                put_tbl=db_top[db_top.cp_flag=='P']
-                count_call_sel=call_tbl.shape[0]
-                count_call.append(count_call_sel)
-                forward_to_hist_ratio.append(np.mean(db_top.rv_d_forward/db_top.rv_d_hist))
-                # First evaluate call options
-                call_imp_to_hist_ratio_sel=call_tbl.impl_volatility/call_tbl.rv_d_hist
-                call_imp_to_hist_ratio.append(np.mean(call_imp_to_hist_ratio_sel))
-                
-                call_forward_to_imp_sel=call_tbl.rv_d_forward/call_tbl.impl_volatility
-                call_forward_to_imp.append(np.mean(call_forward_to_imp_sel))
-                
-                
-                call_gain_mu.append(np.mean(call_tbl['%profit']))
-                ratio_in_money_call=np.sum(call_tbl.profit>0)/count_call_sel
-                call_in_money_ratio.append(ratio_in_money_call)
-                
-                mu_in_money_call=np.mean(call_tbl[call_tbl.profit>0]['%profit'])
-                call_in_money_mu.append(mu_in_money_call)
-                
-                ratio_at_money_call=np.sum(call_tbl.profit==0)/count_call_sel
-                call_at_money_ratio.append(ratio_at_money_call)
-                
-                ratio_out_money_call=np.sum(call_tbl.profit<0)/count_call_sel
-                call_out_money_ratio.append(ratio_out_money_call)
-                
-                mu_out_money_call=np.mean(call_tbl[call_tbl.profit<0]['%profit'])
-                call_out_money_mu.append(mu_out_money_call)
-                # Now evaluate put options
-                count_put_sel=count_call_sel
-                
-                put_imp_to_hist_ratio_sel=put_tbl.impl_volatility/put_tbl.rv_d_hist
-                put_imp_to_hist_ratio.append(np.mean(put_imp_to_hist_ratio_sel))
-                
-                put_forward_to_imp_sel=put_tbl.rv_d_forward/put_tbl.impl_volatility
-                put_forward_to_imp.append(np.mean(put_forward_to_imp_sel))
-                
-                put_gain_mu.append(np.mean(put_tbl['%profit']))
-                ratio_in_money_put=np.sum(put_tbl.profit>0)/count_put_sel
-                put_in_money_ratio.append(ratio_in_money_put)
-                
-                mu_in_money_put=np.mean(put_tbl[put_tbl.profit>0]['%profit'])
-                put_in_money_mu.append(mu_in_money_put)
-                
-                ratio_at_money_put=np.sum(put_tbl.profit==0)/count_put_sel
-                put_at_money_ratio.append(ratio_at_money_put)
-                
-                ratio_out_money_put=np.sum(put_tbl.profit<0)/count_put_sel
-                put_out_money_ratio.append(ratio_out_money_put)
-                
-                mu_out_money_put=np.mean(put_tbl[put_tbl.profit<0]['%profit'])
-                put_out_money_mu.append(mu_out_money_put)
-                
+            db_top=self.top_year(year_sel,market_cap_count,horizon,side='buy')
+            if type(db_top)==pd.DataFrame:
+                db_list.append(db_top)
                 print('Buy-side analysis completed  for year '+str(year_sel)+' ...')
             else:
                 print('Processed dataset missing for year '+str(year_sel)+' ...')
         ## Store results in a DataFrame
-        result_tbl=pd.DataFrame()
-        result_tbl['year']=study_period
-
-        result_tbl['count p/c']=count_call
-        result_tbl['forward/hist vol']=forward_to_hist_ratio
-
-        result_tbl['c implied/hist vol']=call_imp_to_hist_ratio
-        result_tbl['c implied/forward vol']=np.power(call_forward_to_imp,-1)
-
-        result_tbl['c %gain']=call_gain_mu
-
-        mean_call_gain=((1+np.mean(call_gain_mu))**(365/horizon))-1
-
-
-        result_tbl['c in-money ratio']=call_in_money_ratio
-        result_tbl['c in-money gain']=call_in_money_mu
-
-        result_tbl['c out-money ratio']=call_out_money_ratio
-        result_tbl['c out-money gain']=call_out_money_mu
-        
-        result_tbl['p implied/hist vol']=put_imp_to_hist_ratio
-        result_tbl['p implied/forward vol']=np.power(put_forward_to_imp,-1)
-        
-        mean_put_gain=((1+np.mean(put_gain_mu))**(365/horizon))-1
-        result_tbl['p %gain']=put_gain_mu
-
-        result_tbl['p in-money ratio']=put_in_money_ratio
-        result_tbl['p in-money gain']=put_in_money_mu
+        db_all=pd.concat(db_list,ignore_index=True)
+        result_tbl=agg_stats(db_all,freq=freq)
 
-        result_tbl['p out-money ratio']=put_out_money_ratio
-        result_tbl['p out-money gain']=put_out_money_mu
+        mean_call_gain=((1+np.mean(result_tbl['c %gain']))**(365/horizon))-1
+        mean_put_gain=((1+np.mean(result_tbl['p %gain']))**(365/horizon))-1
+        if boot!=None:
+            ci_tbl,annual_ci=block_bootstrap(db_all,freq=freq,horizon=horizon,n_draws=boot,
+                                             block=block,method=boot_method,conf=conf)
+            result_tbl=join_ci(result_tbl,ci_tbl)
 
         # Testing call against put for implied/historical and forward/implied
 
-        test_Res1=ttest_ind(call_imp_to_hist_ratio, put_imp_to_hist_ratio)
+        test_Res1=ttest_ind(result_tbl['c implied/hist vol'], result_tbl['p implied/hist vol'])
         p_val_ttest1=test_Res1[1]
 
-        test_Res2=ttest_ind(call_forward_to_imp, put_forward_to_imp)
+        test_Res2=ttest_ind(np.power(result_tbl['c implied/forward vol'],-1),
+                            np.power(result_tbl['p implied/forward vol'],-1))
         p_val_ttest2=test_Res2[1]
 
         ## Now plotting 
+        if freq=='Y':
+            X_axis=pd.to_datetime(result_tbl['year'],format='%Y')
+        else:
+            X_axis=result_tbl['period']
 
         # First plot basics – various ratios
         fig, ax = plt.subplots()
-        X_axis=result_tbl['year']
-        X_axis=pd.to_datetime(X_axis,format='%Y')
         ax.plot(X_axis,result_tbl['forward/hist vol'],'s-y',label='forward/historical')
 
         ax.plot(X_axis,(result_tbl['c implied/hist vol']+\
@@ -463,8 +477,6 @@ class OptionM:
 
         # plot on % options in and out-of money
         fig, ax = plt.subplots()
-        X_axis=result_tbl['year']
-        X_axis=pd.to_datetime(X_axis,format='%Y')
         ax.plot(X_axis,result_tbl['c in-money ratio']*100,'^-r',label='call in-money')
         ax.plot(X_axis,result_tbl['p in-money ratio']*100,'^-b',label='put in-money')
         ax.plot(X_axis,result_tbl['c out-money ratio']*100,'v-r',label='call out-of-money')
@@ -479,8 +491,6 @@ class OptionM:
 
         # plot on how profitable are options
         fig, ax = plt.subplots()
-        X_axis=result_tbl['year']
-        X_axis=pd.to_datetime(X_axis,format='%Y')
         ax.axhline(0,c='k',ls='--',lw=1)
         ax.plot(X_axis,result_tbl['c in-money gain']*100,'^-r',label='in-money call')
         ax.plot(X_axis,result_tbl['p in-money gain']*100,'^-b',label='in-money put')
@@ -500,15 +510,24 @@ class OptionM:
 
         print('average annualised gain to BUY CALL is '+str(np.around(mean_call_gain*100,2))+'% for '
               +str(study_period[0])+' - '+str(study_period[-1]))
+        if boot!=None:
+            print(str(int(conf*100))+'% block-bootstrap interval for BUY CALL is '+
+                  str(np.around(annual_ci['c'][0]*100,2))+'% to '+
+                  str(np.around(annual_ci['c'][1]*100,2))+'%')
 
         
         print('average annualised gain to BUY PUT is '+str(np.around(mean_put_gain*100,2))+'% for '
               +str(study_period[0])+' - '+str(study_period[-1]))
+        if boot!=None:
+            print(str(int(conf*100))+'% block-bootstrap interval for BUY PUT is '+
+                  str(np.around(annual_ci['p'][0]*100,2))+'% to '+
+                  str(np.around(annual_ci['p'][1]*100,2))+'%')
         print('The results are stored in a DataFrame and returned with this method')
         return result_tbl
          
     # END OF THIRD PROCEDURE
-    def analyse_sell(self,market_cap_count=100,horizon=None,study_period=None):
+    def analyse_sell(self,market_cap_count=100,horizon=None,study_period=None,freq='Y',
+                     boot=None,block=None,boot_method='moving',conf=0.95):
         db=self.db        
         if type(horizon)!=int:
             horizon=self.h
@@ -520,164 +539,41 @@ class OptionM:
         else:
             self.s=study_period
         
-        sql_query_init="""select dsf.cusip, dsf.permno, dsf.date, dsf.prc, dsf.shrout,
-        dsfhdr.hshrcd, dsfhdr.htick, dsfhdr.hcomnam from crsp.dsf join crsp.dsfhdr on dsfhdr.cusip=dsf.cusip
-        where date='1995-12-31' and dsf.hexcd>=1 and dsf.hexcd<=3 and dsfhdr.hshrcd>=10
-        and dsfhdr.hshrcd<=11"""
+        if freq not in freq_choices:
+            raise ValueError('freq must be one of '+', '.join(freq_choices))
+        if boot_method not in boot_choices:
+            raise ValueError('boot_method must be one of '+', '.join(boot_choices))
         
         print('top '+str(market_cap_count)+' US firms by Market Cap are studied between '+
               str(study_period[0])+' - '+str(study_period[-1]))
-        count_call=[]
-        forward_to_hist_ratio=[]
-        call_imp_to_hist_ratio=[]
-        call_forward_to_imp=[]
-        call_gain_mu=[]
-        call_in_money_ratio=[]
-        call_at_money_ratio=[]
-        call_out_money_ratio=[]
-
-        call_in_money_mu=[]
-        call_out_money_mu=[]
-
-        put_imp_to_hist_ratio=[]
-        put_forward_to_imp=[]
-
-        put_gain_mu=[]
-        put_in_money_ratio=[]
-        put_at_money_ratio=[]
-        put_out_money_ratio=[]
-
-        put_in_money_mu=[]
-        put_out_money_mu=[]
+        db_list=[]
 
         for year_sel in study_period:
-            flname='Study_table_'+str(year_sel)+'_'+str(horizon)+'_proc.csv'
-            if isfile(flname):
-                proc_db=pd.read_csv(flname)
-                #db.describe_table('crsp', 'dsfhdr')
-                crs_tbl=db.raw_sql(sql_query_init)
-                day_back=0
-                while crs_tbl.shape[0]==0:
-                    day_back-=1
-                    last_date_trading=datetime(year=year_sel,month=1,day=1)+timedelta(days=day_back)
-                    last_date_trading.strftime('%Y-%m-%d')
-                    new_sql_query=sql_query_init.replace('1995-12-31',
-                                                         last_date_trading.strftime('%Y-%m-%d'))
-                    
-                    crs_tbl=db.raw_sql(new_sql_query)
-                crs_tbl['mkval']=crs_tbl.prc*crs_tbl.shrout
-                crs_tbl=crs_tbl.sort_values(by='mkval',ascending=False,ignore_index=True)
-                top_mkcap_cusip=crs_tbl.cusip[0:market_cap_count].values
-                db_top=pd.DataFrame()
-                for cusip_top in top_mkcap_cusip:
-                    proc_db_sel=proc_db[proc_db.cusip.values==cusip_top]
-                    if proc_db_sel.shape[0]>0:
-                        db_top=db_top.append(proc_db_sel)
-                db_top=db_top.drop(db_top[db_top.rv_d_hist==0].index)
-                db_top=db_top.reset_index(drop=True)
-                
-                db_top['profit']=(db_top.cp_flag=='C').astype(int)*\
-                    (db_top.premium+db_top.forward_price-db_top.real_forward_price)+\
-                        (db_top.cp_flag=='P').astype(int)*\
-                            (db_top.premium+db_top.real_forward_price-db_top.forward_price)
-                db_top['profit'][db_top['profit']>=db_top['premium']]=\
-                    db_top['premium'][db_top['profit']>=db_top['premium']]
-                db_top['%profit']=db_top['profit']/db_top['forward_price']
-                call_tbl=db_top[db_top.cp_flag=='C']
-                count_trading_days=np.unique(call_tbl.date).shape[0]
-                put_tbl=db_top[db_top.cp_flag=='P']
-                count_call_sel=call_tbl.shape[0]
-                count_call.append(count_call_sel)
-                forward_to_hist_ratio.append(np.mean(db_top.rv_d_forward/db_top.rv_d_hist))
-                # First evaluate call options
-                call_imp_to_hist_ratio_sel=call_tbl.impl_volatility/call_tbl.rv_d_hist
-                call_imp_to_hist_ratio.append(np.mean(call_imp_to_hist_ratio_sel))
-                
-                call_forward_to_imp_sel=call_tbl.rv_d_forward/call_tbl.impl_volatility
-                call_forward_to_imp.append(np.mean(call_forward_to_imp_sel))
-                
-                
-                call_gain_mu.append(np.mean(call_tbl['%profit']))
-                ratio_in_money_call=np.sum(call_tbl.profit>0)/count_call_sel
-                call_in_money_ratio.append(ratio_in_money_call)
-                
-                mu_in_money_call=np.mean(call_tbl[call_tbl.profit>0]['%profit'])
-                call_in_money_mu.append(mu_in_money_call)
-                
-                ratio_at_money_call=np.sum(call_tbl.profit==0)/count_call_sel
-                call_at_money_ratio.append(ratio_at_money_call)
-                
-                ratio_out_money_call=np.sum(call_tbl.profit<0)/count_call_sel
-                call_out_money_ratio.append(ratio_out_money_call)
-                
-                mu_out_money_call=np.mean(call_tbl[call_tbl.profit<0]['%profit'])
-                call_out_money_mu.append(mu_out_money_call)
-                # Now evaluate put options
-                count_put_sel=count_call_sel
-                
-                put_imp_to_hist_ratio_sel=put_tbl.impl_volatility/put_tbl.rv_d_hist
-                put_imp_to_hist_ratio.append(np.mean(put_imp_to_hist_ratio_sel))
-                
-                put_forward_to_imp_sel=put_tbl.rv_d_forward/put_tbl.impl_volatility
-                put_forward_to_imp.append(np.mean(put_forward_to_imp_sel))
-                
-                put_gain_mu.append(np.mean(put_tbl['%profit']))
-                ratio_in_money_put=np.sum(put_tbl.profit>0)/count_put_sel
-                put_in_money_ratio.append(ratio_in_money_put)
-                
-                mu_in_money_put=np.mean(put_tbl[put_tbl.profit>0]['%profit'])
-                put_in_money_mu.append(mu_in_money_put)
-                
-                ratio_at_money_put=np.sum(put_tbl.profit==0)/count_put_sel
-                put_at_money_ratio.append(ratio_at_money_put)
-                
-                ratio_out_money_put=np.sum(put_tbl.profit<0)/count_put_sel
-                put_out_money_ratio.append(ratio_out_money_put)
-                
-                mu_out_money_put=np.mean(put_tbl[put_tbl.profit<0]['%profit'])
-                put_out_money_mu.append(mu_out_money_put)
-                
+            db_top=self.top_year(year_sel,market_cap_count,horizon,side='sell')
+            if type(db_top)==pd.DataFrame:
+                db_list.append(db_top)
                 print('Sell-side analysis completed for year '+str(year_sel)+' ...')
             else:
                 print('Processed dataset missing for year '+str(year_sel)+' ...')
         ## Store results in a DataFrame
-        result_tbl=pd.DataFrame()
-        result_tbl['year']=study_period
-
-        result_tbl['count p/c']=count_call
-        result_tbl['forward/hist vol']=forward_to_hist_ratio
-
-        result_tbl['c implied/hist vol']=call_imp_to_hist_ratio
-        result_tbl['c implied/forward vol']=np.power(call_forward_to_imp,-1)
-
-        result_tbl['c %gain']=call_gain_mu
-
-        mean_call_gain=((1+np.mean(call_gain_mu))**(365/horizon))-1
-
-        result_tbl['c in-money ratio']=call_in_money_ratio
-        result_tbl['c in-money gain']=call_in_money_mu
-
-        result_tbl['c out-money ratio']=call_out_money_ratio
-        result_tbl['c out-money gain']=call_out_money_mu
+        db_all=pd.concat(db_list,ignore_index=True)
+        result_tbl=agg_stats(db_all,freq=freq)
 
-        result_tbl['p implied/hist vol']=put_imp_to_hist_ratio
-        result_tbl['p implied/forward vol']=np.power(put_forward_to_imp,-1)
-
-        result_tbl['p %gain']=put_gain_mu
-        mean_put_gain=((1+np.mean(put_gain_mu))**(365/horizon))-1
-
-        result_tbl['p in-money ratio']=put_in_money_ratio
-        result_tbl['p in-money gain']=put_in_money_mu
-
-        result_tbl['p out-money ratio']=put_out_money_ratio
-        result_tbl['p out-money gain']=put_out_money_mu
+        mean_call_gain=((1+np.mean(result_tbl['c %gain']))**(365/horizon))-1
+        mean_put_gain=((1+np.mean(result_tbl['p %gain']))**(365/horizon))-1
+        if boot!=None:
+            ci_tbl,annual_ci=block_bootstrap(db_all,freq=freq,horizon=horizon,n_draws=boot,
+                                             block=block,method=boot_method,conf=conf)
+            result_tbl=join_ci(result_tbl,ci_tbl)
 
         ## Now plotting 
+        if freq=='Y':
+            X_axis=pd.to_datetime(result_tbl['year'],format='%Y')
+        else:
+            X_axis=result_tbl['period']
 
         # plot on % options in and out-of money
         fig, ax = plt.subplots()
-        X_axis=result_tbl['year']
-        X_axis=pd.to_datetime(X_axis,format='%Y')
         ax.plot(X_axis,result_tbl['c in-money ratio']*100,'^-r',label='call in-money')
         ax.plot(X_axis,result_tbl['p in-money ratio']*100,'^-b',label='put in-money')
         ax.plot(X_axis,result_tbl['c out-money ratio']*100,'v-r',label='call out-of-money')
@@ -692,8 +588,6 @@ class OptionM:
 
         # plot on how profitable are options
         fig, ax = plt.subplots()
-        X_axis=result_tbl['year']
-        X_axis=pd.to_datetime(X_axis,format='%Y')
         ax.axhline(0,c='k',ls='--',lw=1)
         ax.plot(X_axis,result_tbl['c in-money gain']*100,'^-r',label='in-money call')
         ax.plot(X_axis,result_tbl['p in-money gain']*100,'^-b',label='in-money put')
@@ -713,10 +607,107 @@ class OptionM:
 
         print('average annualised gain to SELL CALL is '+str(np.around(mean_call_gain*100,2))+'% for '
               +str(study_period[0])+' - '+str(study_period[-1]))
+        if boot!=None:
+            print(str(int(conf*100))+'% block-bootstrap interval for SELL CALL is '+
+                  str(np.around(annual_ci['c'][0]*100,2))+'% to '+
+                  str(np.around(annual_ci['c'][1]*100,2))+'%')
 
         print('average annualised gain to SELL PUT is '+str(np.around(mean_put_gain*100,2))+'% for '
               +str(study_period[0])+' - '+str(study_period[-1]))
+        if boot!=None:
+            print(str(int(conf*100))+'% block-bootstrap interval for SELL PUT is '+
+                  str(np.around(annual_ci['p'][0]*100,2))+'% to '+
+                  str(np.around(annual_ci['p'][1]*100,2))+'%')
         print('The results are stored in a DataFrame and returned with this method')
         return result_tbl
-         
-         
+    
+    # END OF FOURTH PROCEDURE
+    def quick_look(self,frac=0.05,side='buy',market_cap_count=100,horizon=None,
+                   study_period=None,freq='Y',conf=0.95,seed=0):
+        '''Approximate buy- or sell-side analysis on a stratified sample of 
+        records (see gen_db_sample) without running step2_proc(). Every statistic
+        is reported with its conf confidence interval in the lower/upper columns,
+        clustered by firm as records of a firm within a period are correlated.'''
+        if type(horizon)!=int:
+            horizon=self.h
+        else:
+            self.h=horizon
+            
+        if study_period==None:
+            study_period=self.s
+        else:
+            self.s=study_period
+        
+        if freq not in freq_choices:
+            raise ValueError('freq must be one of '+', '.join(freq_choices))
+        if frac<=0 or frac>1:
+            raise ValueError('frac must be between 0 and 1')
+        
+        p=Pool()
+        p.map(partial(gen_db_sample,frac=frac,progress_step=self.p,horizon=horizon,
+                      seed=seed),study_period)
+        p.terminate()
+        
+        print('Quick look at top '+str(market_cap_count)+' US firms by Market Cap with '+
+              str(frac*100)+'% of records between '+
+              str(study_period[0])+' - '+str(study_period[-1]))
+        db_list=[]
+        for year_sel in study_period:
+            db_top=self.top_year(year_sel,market_cap_count,horizon,side=side,
+                                 table='sample'+str(frac)+'_'+str(seed))
+            if type(db_top)==pd.DataFrame:
+                db_list.append(db_top)
+            else:
+                print('Sampled dataset missing for year '+str(year_sel)+' ...')
+        db_all=pd.concat(db_list,ignore_index=True)
+        result_tbl=agg_stats(db_all,freq=freq,conf=conf)
+        
+        mean_call_gain=((1+np.mean(result_tbl['c %gain']))**(365/horizon))-1
+        mean_put_gain=((1+np.mean(result_tbl['p %gain']))**(365/horizon))-1
+        print('approximate annualised gain to '+side.upper()+' CALL is '+
+              str(np.around(mean_call_gain*100,2))+'% for '
+              +str(study_period[0])+' - '+str(study_period[-1]))
+        print('approximate annualised gain to '+side.upper()+' PUT is '+
+              str(np.around(mean_put_gain*100,2))+'% for '
+              +str(study_period[0])+' - '+str(study_period[-1]))
+        print('The results are stored in a DataFrame and returned with this method')
+        return result_tbl
+    
+    # END OF QUICK LOOK
+    def analyse_panel(self,market_cap_count=100,horizon=None,study_period=None,
+                      side='buy',by=['secid','year'],se='nw',lags=None):
+        '''Tests per group in by (e.g. ['secid','year'], ['secid'] or ['year'])
+        whether call/put %gain differ from zero, implied/realised vol ratios 
+        from one, and calls from puts for the top market_cap_count firms.
+        se is 'iid', 'nw' (Newey-West with lags, by default the number of 
+        overlapping trading days in the horizon; per-day averages when 'secid'
+        is not in by) or 'cluster' (by firm, so 'secid' must not be in by).
+        Returns a tidy DataFrame (see panel_stats.panel_tests).'''
+        if type(horizon)!=int:
+            horizon=self.h
+        else:
+            self.h=horizon
+            
+        if study_period==None:
+            study_period=self.s
+        else:
+            self.s=study_period
+        
+        if se not in se_choices:
+            raise ValueError('se must be one of '+', '.join(se_choices))
+        if se=='cluster' and 'secid' in by:
+            raise ValueError("se='cluster' clusters by firm and needs by without 'secid', e.g. by=['year']")
+        if lags==None:
+            lags=int(np.round(horizon*252/365))-1
+        
+        db_list=[]
+        for year_sel in study_period:
+            db_top=self.top_year(year_sel,market_cap_count,horizon,side=side)
+            if type(db_top)==pd.DataFrame:
+                db_list.append(db_top)
+            else:
+                print('Processed dataset missing for year '+str(year_sel)+' ...')
+        db_all=pd.concat(db_list,ignore_index=True)
+        result_tbl=panel_tests(db_all,by=by,se=se,lags=lags)
+        print('Panel tests completed for '+str(result_tbl.shape[0])+' groups and statistics')
+        return result_tbl
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Panel statistics for the processed OptionMetrics records.
+
+This script includes:
+    – batched tests of whether group means differ from a null value, with
+    iid, Newey-West or clustered standard errors,
+    – paired tests of call against put means on the same security and date,
+    – a function to run these tests per firm and/or per year on the buy- or
+    sell-side records and return a tidy table.
+    – a moving or stationary block bootstrap of the daily %gain series by
+    option type, for the confidence intervals of the buy/sell-side reports.
+All tests are computed with bincount over integer group codes, so thousands
+of firm-years cost a handful of array operations rather than a Python loop.
+
+Common disclaimers apply.
+
+Script by Arman Hassanniakalager GitHub @hkalager
+"""
+import pandas as pd
+import numpy as np
+import warnings
+from scipy.stats import t as t_dist
+from multiprocessing import Pool
+
+se_choices=['iid','nw','cluster']
+boot_choices=['moving','stationary']
+
+def group_mean_test(values,codes,n_groups,null=0,se='iid',lags=0,clusters=None):
+    '''Tests for every group whether the mean of values differs from null.
+    values and codes (integer group codes from 0 to n_groups-1) must be sorted
+    by group then date for se='nw'. lags is the Newey-West lag length and
+    clusters the integer cluster codes for se='cluster'.
+    Returns a dict of arrays n, estimate, se, dof, t_stat and p_value by group.'''
+    if se not in se_choices:
+        raise ValueError('se must be one of '+', '.join(se_choices))
+    values=np.asarray(values,dtype=float)
+    codes=np.asarray(codes)
+    n=np.bincount(codes,minlength=n_groups).astype(float)
+    if values.shape[0]==0:
+        nan_arr=np.full(n_groups,np.nan)
+        return {'n':n,'estimate':nan_arr,'se':nan_arr.copy(),'dof':nan_arr.copy(),
+                't_stat':nan_arr.copy(),'p_value':nan_arr.copy()}
+    with np.errstate(divide='ignore',invalid='ignore'):
+        mean=np.bincount(codes,values,minlength=n_groups)/n
+        resid=values-mean[codes]
+        if se=='iid':
+            var_sum=np.bincount(codes,resid*resid,minlength=n_groups)*n/(n-1)
+            dof=n-1
+        elif se=='nw':
+            # Bartlett-weighted autocovariances within each group
+            var_sum=np.bincount(codes,resid*resid,minlength=n_groups)
+            for lag in range(1,lags+1):
+                same_group=codes[lag:]==codes[:-lag]
+                cross=resid[lag:]*resid[:-lag]*same_group
+                var_sum+=2*(1-lag/(lags+1))*np.bincount(codes[lag:],cross,
+                                                        minlength=n_groups)
+            dof=n-1
+        else:
+            # Residuals summed within each (group, cluster) pair
+            pair_code,pair_idx=np.unique(codes.astype(np.int64)*(np.max(clusters)+1)+clusters,
+                                         return_inverse=True)
+            pair_group=pair_code//(np.max(clusters)+1)
+            pair_sum=np.bincount(pair_idx,resid)
+            count_cluster=np.bincount(pair_group,minlength=n_groups).astype(float)
+            var_sum=np.bincount(pair_group,pair_sum*pair_sum,minlength=n_groups)*\
+                count_cluster/(count_cluster-1)
+            dof=count_cluster-1
+        se_mean=np.power(var_sum,.5)/n
+        t_stat=(mean-null)/se_mean
+        p_value=2*t_dist.sf(np.abs(t_stat),dof)
+    return {'n':n,'estimate':mean,'se':se_mean,'dof':dof,'t_stat':t_stat,'p_value':p_value}
+
+def panel_tests(db_top,by=['secid','year'],se='nw',lags=0,cluster='secid'):
+    '''Runs the tests for every group in by (columns of db_top; 'year' is
+    taken from the date) on the buy- or sell-side records of db_top as returned
+    by OptionM.top_year():
+        * %gain of calls and puts against zero,
+        * implied/hist vol and implied/forward vol of calls and puts against one,
+        * each of the above for calls against puts, as the mean difference of
+        the call and put on the same security and date (n counts the pairs).
+    With se='cluster' the cluster column must not be in by, as each group
+    would hold a single cluster. With se='nw' and 'secid' not in by, the 
+    records of each group are averaged by date first so the lags count 
+    trading days; n still counts records.
+    Returns a tidy DataFrame with one row per group, statistic and option type.'''
+    if se=='cluster' and cluster in by:
+        raise ValueError('cannot cluster by '+cluster+' within groups by '+', '.join(by))
+    by_day=se=='nw' and 'secid' not in by
+    db_test=db_top.copy()
+    db_test['date']=pd.to_datetime(db_test['date'])
+    db_test['year']=db_test['date'].dt.year
+    db_test=db_test.sort_values(by=by+['date'],ignore_index=True)
+    db_test['%gain']=db_test['%profit']
+    db_test['implied/hist vol']=db_test.impl_volatility/db_test.rv_d_hist
+    db_test['implied/forward vol']=db_test.impl_volatility/db_test.rv_d_forward
+    group_codes=db_test.groupby(by,sort=True).ngroup().values
+    group_keys=db_test.groupby(by,sort=True).size().index.to_frame(index=False)
+    n_groups=group_keys.shape[0]
+    cluster_codes=pd.factorize(db_test[cluster])[0]
+
+    def _test(values,codes,clusters,dates,null):
+        if by_day:
+            # Cross-sectional mean by date within each group, sorted by date
+            day_mean=pd.Series(values).groupby([codes,dates]).mean()
+            test_sel=group_mean_test(day_mean.values,day_mean.index.get_level_values(0).values,
+                                     n_groups,null=null,se=se,lags=lags)
+            test_sel['n']=np.bincount(codes,minlength=n_groups).astype(float)
+            return test_sel
+        return group_mean_test(values,codes,n_groups,null=null,se=se,lags=lags,
+                               clusters=clusters)
+
+    test_list=[]
+    for stat,null in [('%gain',0),('implied/hist vol',1),('implied/forward vol',1)]:
+        is_valid=np.isfinite(db_test[stat].values)
+        test_flag={}
+        for flag in ['C','P']:
+            is_flag=is_valid&(db_test.cp_flag.values==flag)
+            test_flag[flag]=_test(db_test[stat].values[is_flag],group_codes[is_flag],
+                                  cluster_codes[is_flag],db_test['date'].values[is_flag],null)
+        # Calls against puts as the mean of the paired differences C-P on the
+        # same security and date, as their gains move together
+        pair_tbl=pd.DataFrame({'x':db_test[stat].values,'code':group_codes,
+                               'cluster':cluster_codes},index=db_test.index)[is_valid]
+        pair_tbl=pair_tbl.groupby([db_test.secid[is_valid],db_test.date[is_valid],
+                                   db_test.cp_flag[is_valid]]).agg(
+                                       {'x':'mean','code':'first','cluster':'first'})
+        pair_tbl=pair_tbl.unstack('cp_flag').dropna()
+        pair_tbl=pair_tbl.reset_index().sort_values(by=[('code','C'),'date'])
+        test_flag['C-P']=_test((pair_tbl[('x','C')]-pair_tbl[('x','P')]).values,
+                               pair_tbl[('code','C')].values.astype(np.int64),
+                               pair_tbl[('cluster','C')].values.astype(np.int64),
+                               pair_tbl['date'].values,0)
+        for flag in ['C','P','C-P']:
+            test_tbl=group_keys.copy()
+            test_tbl['stat']=stat
+            test_tbl['cp_flag']=flag
+            test_tbl['null']=null if flag!='C-P' else 0
+            for col in ['n','estimate','se','t_stat','p_value']:
+                test_tbl[col]=test_flag[flag][col]
+            test_list.append(test_tbl)
+    result_tbl=pd.concat(test_list,ignore_index=True)
+    result_tbl['n']=result_tbl['n'].astype(int)
+    return result_tbl
+
+def boot_index(n_obs,n_draws,block,method='moving',rng=None):
+    '''Returns an (n_draws, n_obs) matrix of resampled positions from 0 to
+    n_obs-1. method='moving' joins blocks of fixed length block drawn at random
+    starts; method='stationary' joins blocks of geometric length with mean 
+    block, wrapping around the end of the series (Politis and Romano, 1994).'''
+    if rng==None:
+        rng=np.random.default_rng()
+    if method=='moving':
+        count_block=int(np.ceil(n_obs/block))
+        starts=rng.integers(0,n_obs-block+1,size=(n_draws,count_block))
+        idx=(starts[:,:,None]+np.arange(block)).reshape(n_draws,-1)[:,:n_obs]
+    elif method=='stationary':
+        is_new=rng.random((n_draws,n_obs))<1/block
+        is_new[:,0]=True
+        starts=rng.integers(0,n_obs,size=(n_draws,n_obs))
+        # position where the current block started, carried forward
+        block_pos=np.maximum.accumulate(np.where(is_new,np.arange(n_obs),0),axis=1)
+        block_start=np.take_along_axis(starts,block_pos,axis=1)
+        idx=(block_start+np.arange(n_obs)-block_pos)%n_obs
+    else:
+        raise ValueError('method must be one of '+', '.join(boot_choices))
+    return idx
+
+def _boot_chunk(sum_arr,count_arr,period_start,block,method,n_draws,seed):
+    # Resampled days summed within each period (day j of a draw stands in for
+    # day j of the series), then ratio of sums to counts for every statistic
+    idx=boot_index(sum_arr.shape[0],n_draws,block,method,np.random.default_rng(seed))
+    sum_draw=np.add.reduceat(sum_arr[idx],period_start,axis=1)
+    count_draw=np.add.reduceat(count_arr[idx],period_start,axis=1)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return sum_draw/count_draw
+
+def block_bootstrap(db_top,freq='Y',horizon=91,n_draws=10000,block=None,
+                    method='moving',conf=0.95,seed=0,processes=None):
+    '''Block bootstrap of the daily series of call and put records in db_top
+    (with profit and %profit columns). Each draw resamples the whole study 
+    period at once, so blocks run across period boundaries, and the draw is
+    then summed by calendar period of freq. block defaults to the trading days
+    in horizon, capped at the length of the series. The draws are split across
+    a pool of processes.
+    Returns a DataFrame with the lower/upper bounds of %gain, in-money gain 
+    and out-money gain by period, and a dict with the bounds of the 
+    annualised average gain of calls ('c') and puts ('p') from the same draws.'''
+    if method not in boot_choices:
+        raise ValueError('method must be one of '+', '.join(boot_choices))
+    if block==None:
+        block=int(np.round(horizon*252/365))
+    gain_list=['%gain','in-money gain','out-money gain']
+    db_day=pd.DataFrame(index=db_top.index)
+    db_day['%gain']=db_top['%profit']
+    db_day['in-money gain']=db_top['%profit'].where(db_top.profit>0)
+    db_day['out-money gain']=db_top['%profit'].where(db_top.profit<0)
+    date=pd.to_datetime(db_top['date'])
+    sum_tbl=pd.concat({'sum':db_day.fillna(0),'count':db_day.notna().astype(float)},axis=1)
+    sum_tbl=sum_tbl.groupby([db_top['cp_flag'],date]).sum()
+    
+    task_list=[]
+    task_key=[]
+    flag_period={}
+    seed_seq=np.random.SeedSequence(seed)
+    for flag,day_tbl in sum_tbl.groupby(level='cp_flag'):
+        sum_arr=day_tbl['sum'][gain_list].values
+        count_arr=day_tbl['count'][gain_list].values
+        n_days=sum_arr.shape[0]
+        day_period=day_tbl.index.get_level_values('date').to_period(freq)
+        period_start=np.flatnonzero(np.r_[True,day_period[1:]!=day_period[:-1]])
+        flag_period[flag]=day_period[period_start]
+        block_sel=max(1,min(block,n_days))
+        # About 2 million resampled days per task to bound the memory
+        chunk_size=max(1,min(n_draws,2000000//n_days))
+        for draw_lo in range(0,n_draws,chunk_size):
+            task_list.append((sum_arr,count_arr,period_start,block_sel,method,
+                              min(chunk_size,n_draws-draw_lo),seed_seq.spawn(1)[0]))
+            task_key.append(flag)
+    with Pool(processes) as p:
+        draw_list=p.starmap(_boot_chunk,task_list)
+    
+    alpha=(1-conf)/2
+    period_list=sum_tbl.index.get_level_values('date').to_period(freq).unique().sort_values()
+    ci_tbl=pd.DataFrame(index=period_list)
+    annual_ci={}
+    for flag in ['C','P']:
+        lbl=flag.lower()+' '
+        for col in gain_list:
+            ci_tbl[lbl+col+' lower']=np.nan
+            ci_tbl[lbl+col+' upper']=np.nan
+        if flag not in flag_period:
+            annual_ci[flag.lower()]=(np.nan,np.nan)
+            continue
+        draw_sel=np.concatenate([draw for key,draw in zip(task_key,draw_list) if key==flag])
+        with warnings.catch_warnings():
+            # Periods without in-money or out-money records give all-NaN draws
+            warnings.simplefilter('ignore',RuntimeWarning)
+            lower,upper=np.nanquantile(draw_sel,[alpha,1-alpha],axis=0)
+        for i_col,col in enumerate(gain_list):
+            ci_tbl.loc[flag_period[flag],lbl+col+' lower']=lower[:,i_col]
+            ci_tbl.loc[flag_period[flag],lbl+col+' upper']=upper[:,i_col]
+        # Average %gain over the periods of each draw, as in the reports
+        with np.errstate(invalid='ignore'):
+            annual_draws=np.power(1+np.nanmean(draw_sel[:,:,0],axis=1),365/horizon)-1
+        annual_ci[flag.lower()]=tuple(np.nanquantile(annual_draws,[alpha,1-alpha]))
+    
+    if freq=='Y':
+        ci_tbl.insert(0,'year',ci_tbl.index.year)
+    else:
+        ci_tbl.insert(0,'period',ci_tbl.index.to_timestamp())
+    ci_tbl=ci_tbl.reset_index(drop=True)
+    return ci_tbl,annual_ci
+
+def join_ci(result_tbl,ci_tbl):
+    '''Adds the lower/upper columns of ci_tbl next to the matching columns of
+    result_tbl, aligned on the year or period column.'''
+    key=result_tbl.columns[0]
+    join_tbl=result_tbl.merge(ci_tbl,on=key,how='left')
+    col_list=[]
+    for col in result_tbl.columns:
+        col_list.append(col)
+        if col+' lower' in ci_tbl.columns:
+            col_list+=[col+' lower',col+' upper']
+    return join_tbl[col_list]
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pipelined execution of step1_crsp(), step2_proc() and the buy/sell-side
+analysis of the OptionM module.
+
+The stages are run as a DAG per year:
+    – step 1 downloads the _crsp.csv tables year by year from WRDS,
+    – step 2 processes year Y as soon as the _crsp.csv tables for Y-1, Y and
+    Y+1 exist (in a pool of processes),
+    – the analysis stage collects the top firms by Market Cap for year Y as
+    soon as the _proc.csv table for Y exists.
+The stages are linked with bounded queues, so the download pauses when the
+processing falls behind rather than piling up tables on disk.
+
+Run from a terminal as:
+    python pipeline.py --start 2001 --end 2020 --horizon 91 --side buy
+
+Common disclaimers apply.
+
+Script by Arman Hassanniakalager GitHub @hkalager
+"""
+import argparse
+import threading
+from queue import Queue,Full,Empty
+from os.path import isfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+from functools import partial
+import pandas as pd
+import numpy as np
+from helper_codes import gen_db,agg_stats,freq_choices
+
+_done=None
+_wait=1  # seconds between checks for cancellation while a queue is blocked
+
+def _put(q,item,cancel):
+    # Blocking put that gives up once the pipeline is cancelled
+    while cancel.is_set()==False:
+        try:
+            q.put(item,timeout=_wait)
+            return True
+        except Full:
+            pass
+    return False
+
+def _get(q,cancel):
+    # Blocking get that returns _done once the pipeline is cancelled
+    while cancel.is_set()==False:
+        try:
+            return q.get(timeout=_wait)
+        except Empty:
+            pass
+    return _done
+
+def _download(om,years,horizon,crsp_q,cancel):
+    # Step 1: one year at a time as WRDS connection is shared by all stages
+    matched_cusip_list=None
+    for year_sel in years:
+        fl_lbl_crsp='Study_table_'+str(year_sel)+'_'+str(horizon)+'_crsp.csv'
+        if isfile(fl_lbl_crsp)==False:
+            if matched_cusip_list==None:
+                with om.db_lock:
+                    matched_cusip_list=om.match_crsp()
+            om.crsp_year(year_sel,horizon,matched_cusip_list)
+        else:
+            print('Matched OptionMetrics-CRSP dataset exists for year '+str(year_sel))
+        if _put(crsp_q,year_sel,cancel)==False:
+            return
+    _put(crsp_q,_done,cancel)
+
+def _process(study_period,horizon,progress_step,workers,crsp_q,proc_q,cancel):
+    # Step 2: submit year Y once Y-1, Y and Y+1 are downloaded. At most 
+    # workers years are in progress; beyond that crsp_q fills up and step 1 waits
+    crsp_ready=set()
+    pending=list(study_period)
+    slots=threading.Semaphore(workers)
+    def _finish(fut,year_sel):
+        slots.release()
+        _put(proc_q,year_sel,cancel)
+    pool=ProcessPoolExecutor(max_workers=workers)
+    futures=[]
+    try:
+        while True:
+            year_ready=_get(crsp_q,cancel)
+            if year_ready==_done:
+                break
+            crsp_ready.add(year_ready)
+            for year_sel in list(pending):
+                if {year_sel-1,year_sel,year_sel+1}<=crsp_ready:
+                    pending.remove(year_sel)
+                    while slots.acquire(timeout=_wait)==False:
+                        if cancel.is_set():
+                            return
+                    fut=pool.submit(gen_db,year_sel,progress_step=progress_step,
+                                    horizon=horizon)
+                    fut.add_done_callback(partial(_finish,year_sel=year_sel))
+                    futures.append(fut)
+        for fut in futures:
+            fut.result()
+    finally:
+        pool.shutdown(wait=cancel.is_set()==False,cancel_futures=cancel.is_set())
+    _put(proc_q,_done,cancel)
+
+def run_pipeline(om,study_period=None,horizon=None,market_cap_count=100,side='buy',
+                 freq='Y',workers=None,queue_size=2,progress_step=None):
+    '''Runs step1_crsp(), step2_proc() and the buy- or sell-side analysis of om
+    (an OptionM object) as a pipeline. queue_size bounds the number of years
+    waiting between two stages and workers (default: all CPUs) the number of 
+    years processed at the same time in step 2.
+    Returns the analysis table as in analyse_buy()/analyse_sell().'''
+    if study_period==None:
+        study_period=om.s
+    if horizon==None:
+        horizon=om.h
+    if progress_step==None:
+        progress_step=om.p
+    if freq not in freq_choices:
+        raise ValueError('freq must be one of '+', '.join(freq_choices))
+    if side not in ['buy','sell']:
+        raise ValueError('side must be buy or sell')
+
+    years=range(study_period[0]-1,study_period[-1]+2)
+    crsp_q=Queue(maxsize=queue_size)
+    proc_q=Queue(maxsize=queue_size)
+    cancel=threading.Event()
+    if workers==None:
+        workers=cpu_count()
+    errors=[]
+    def _guard(target,*args):
+        # Record the error and cancel every stage, so that blocked puts/gets return
+        try:
+            target(*args)
+        except BaseException as err:
+            errors.append(err)
+            cancel.set()
+
+    stage1=threading.Thread(target=_guard,args=(_download,om,years,horizon,crsp_q,cancel),
+                            daemon=True)
+    stage2=threading.Thread(target=_guard,args=(_process,study_period,horizon,progress_step,
+                                                workers,crsp_q,proc_q,cancel),
+                            daemon=True)
+    stage1.start()
+    stage2.start()
+
+    # Analysis stage runs in this thread as results arrive
+    db_list=[]
+    try:
+        while True:
+            year_sel=_get(proc_q,cancel)
+            if year_sel==_done:
+                break
+            db_top=om.top_year(year_sel,market_cap_count,horizon,side=side)
+            if type(db_top)==pd.DataFrame:
+                db_list.append(db_top)
+                print(side.capitalize()+'-side analysis completed for year '+str(year_sel)+' ...')
+            else:
+                print('Processed dataset missing for year '+str(year_sel)+' ...')
+    except BaseException:
+        cancel.set()
+        raise
+    if len(errors)>0:
+        # A download in progress cannot be interrupted; the daemon threads are
+        # left to stop at their next check of cancel
+        stage1.join(timeout=_wait*2)
+        stage2.join(timeout=_wait*2)
+        raise errors[0]
+    stage1.join()
+    stage2.join()
+
+    db_all=pd.concat(db_list,ignore_index=True)
+    result_tbl=agg_stats(db_all,freq=freq)
+    mean_call_gain=((1+np.mean(result_tbl['c %gain']))**(365/horizon))-1
+    mean_put_gain=((1+np.mean(result_tbl['p %gain']))**(365/horizon))-1
+    print('average annualised gain to '+side.upper()+' CALL is '+
+          str(np.around(mean_call_gain*100,2))+'% for '+
+          str(study_period[0])+' - '+str(study_period[-1]))
+    print('average annualised gain to '+side.upper()+' PUT is '+
+          str(np.around(mean_put_gain*100,2))+'% for '+
+          str(study_period[0])+' - '+str(study_period[-1]))
+    return result_tbl
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Pipelined OptionM study')
+    parser.add_argument('--start',type=int,required=True,help='first year of study period')
+    parser.add_argument('--end',type=int,required=True,help='last year of study period')
+    parser.add_argument('--horizon',type=int,default=91)
+    parser.add_argument('--side',choices=['buy','sell'],default='buy')
+    parser.add_argument('--freq',choices=freq_choices,default='Y')
+    parser.add_argument('--market-cap-count',type=int,default=100)
+    parser.add_argument('--workers',type=int,default=None,help='processes in step 2')
+    parser.add_argument('--queue-size',type=int,default=2,help='years queued between stages')
+    parser.add_argument('--progress',type=int,default=100)
+    parser.add_argument('--out',default=None,help='csv file to store the results')
+    args=parser.parse_args()
+
+    from optionm_module import OptionM
+    om=OptionM(study_period=range(args.start,args.end+1),horizon=args.horizon,
+               progress=args.progress)
+    result_tbl=run_pipeline(om,market_cap_count=args.market_cap_count,side=args.side,
+                            freq=args.freq,workers=args.workers,
+                            queue_size=args.queue_size)
+    if args.out==None:
+        print(result_tbl)
+    else:
+        result_tbl.to_csv(args.out,index=False)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Storage and lookup of the listed-option price surface (optionm.opprcd).
+
+This script includes:
+    – the SQL query for one month of optionm.opprcdYYYY with the moneyness,
+    maturity-window and CRSP-universe filters applied in the database,
+    – a function to stream one month of records in chunks into its partition
+    file Surface_table_YYYY_MM.csv,
+    – functions to load a monthly partition indexed by (secid, date, exdate)
+    and to look up contracts by security, date and expiry from the partition
+    of that date only.
+
+Common disclaimers apply.
+
+Script by Arman Hassanniakalager GitHub @hkalager
+"""
+import pandas as pd
+from datetime import datetime
+from os import rename,remove
+from os.path import isfile
+from functools import lru_cache
+
+sql_surface="""SELECT opprcdYYYY.secid,
+    opprcdYYYY.date,
+    opprcdYYYY.exdate,
+    opprcdYYYY.cp_flag,
+    opprcdYYYY.strike_price/1000.0 AS strike,
+    opprcdYYYY.best_bid,
+    opprcdYYYY.best_offer,
+    opprcdYYYY.volume,
+    opprcdYYYY.open_interest,
+    opprcdYYYY.impl_volatility,
+    opprcdYYYY.delta,
+    opprcdYYYY.optionid,
+    secprdYYYY.close,
+    opprcdYYYY.strike_price/1000.0/secprdYYYY.close AS moneyness
+FROM wrds.optionm.opprcdYYYY
+INNER JOIN wrds.optionm.secprdYYYY
+ON ( opprcdYYYY.secid = secprdYYYY.secid
+    AND opprcdYYYY.date = secprdYYYY.date)
+WHERE opprcdYYYY.date >= 'DATE_START' AND opprcdYYYY.date < 'DATE_END'
+    AND opprcdYYYY.exdate-opprcdYYYY.date >= MIN_DAYS
+    AND opprcdYYYY.exdate-opprcdYYYY.date <= MAX_DAYS
+    AND secprdYYYY.close > 0
+    AND opprcdYYYY.strike_price/1000.0 >= MIN_MONEY*secprdYYYY.close
+    AND opprcdYYYY.strike_price/1000.0 <= MAX_MONEY*secprdYYYY.close
+    AND opprcdYYYY.secid IN (SELECT DISTINCT secid FROM wrds.optionm.secnmd
+                             WHERE cusip IN (CUSIP_LIST)) """
+
+surface_cols=['secid','date','exdate','cp_flag','strike','best_bid','best_offer',
+              'volume','open_interest','impl_volatility','delta','optionid',
+              'close','moneyness']
+
+def surface_query(year_sel,month_sel,matched_cusip_list,moneyness=(0.8,1.2),maturity=(7,365)):
+    '''Returns the SQL query for the listed options of month_sel in year_sel
+    with strike/close within moneyness and days to expiry within maturity,
+    on securities in matched_cusip_list.'''
+    date_start=datetime(year_sel,month_sel,1)
+    if month_sel==12:
+        date_end=datetime(year_sel+1,1,1)
+    else:
+        date_end=datetime(year_sel,month_sel+1,1)
+    cusip_list=','.join(["'"+cusip+"'" for cusip in matched_cusip_list])
+    sql_query=sql_surface.replace('YYYY',str(year_sel))
+    sql_query=sql_query.replace('DATE_START',date_start.strftime('%Y-%m-%d'))
+    sql_query=sql_query.replace('DATE_END',date_end.strftime('%Y-%m-%d'))
+    sql_query=sql_query.replace('MIN_DAYS',str(int(maturity[0])))
+    sql_query=sql_query.replace('MAX_DAYS',str(int(maturity[1])))
+    sql_query=sql_query.replace('MIN_MONEY',str(float(moneyness[0])))
+    sql_query=sql_query.replace('MAX_MONEY',str(float(moneyness[1])))
+    sql_query=sql_query.replace('CUSIP_LIST',cusip_list)
+    return sql_query
+
+def surface_file(year_sel,month_sel):
+    return 'Surface_table_'+str(year_sel)+'_'+str(month_sel).zfill(2)+'.csv'
+
+def stream_month(db,year_sel,month_sel,matched_cusip_list,moneyness=(0.8,1.2),
+                 maturity=(7,365),chunksize=500000):
+    '''Streams one month of the listed-option surface from WRDS into its
+    partition file in chunks of chunksize records, so the month is never held
+    in memory at once. The file is written under a .part name and renamed
+    once complete, so an interrupted month is downloaded again. A month 
+    without records is stored as a header-only partition, so it is not 
+    queried again.'''
+    flname=surface_file(year_sel,month_sel)
+    if isfile(flname):
+        print('Option surface partition exists for '+str(year_sel)+'-'+str(month_sel).zfill(2))
+        return
+    fl_part=flname+'.part'
+    if isfile(fl_part):
+        remove(fl_part)
+    t0=datetime.now()
+    sql_query=surface_query(year_sel,month_sel,matched_cusip_list,moneyness,maturity)
+    count_rec=0
+    for chunk_tbl in db.raw_sql(sql_query,date_cols=['date','exdate'],
+                                chunksize=chunksize,return_iter=True):
+        chunk_tbl.to_csv(fl_part,mode='a',header=count_rec==0,index=False)
+        count_rec+=chunk_tbl.shape[0]
+    if count_rec==0:
+        pd.DataFrame(columns=surface_cols).to_csv(fl_part,index=False)
+    rename(fl_part,flname)
+    dt=datetime.now()-t0
+    print('Option surface for '+str(year_sel)+'-'+str(month_sel).zfill(2)+': '+
+          str(count_rec)+' records after '+str(dt.seconds)+' seconds')
+
+@lru_cache(maxsize=2)
+def load_surface(year_sel,month_sel):
+    '''Loads the surface partition of month_sel in year_sel indexed and 
+    sorted by (secid, date, exdate), so lookups are binary searches. The last
+    two partitions are kept in memory; treat the returned table as read-only.'''
+    flname=surface_file(year_sel,month_sel)
+    if isfile(flname)==False:
+        raise FileNotFoundError('No option surface partition for '+str(year_sel)+
+                                '-'+str(month_sel).zfill(2)+'; run step1_surface() first')
+    surface_tbl=pd.read_csv(flname,parse_dates=['date','exdate'])
+    surface_tbl=surface_tbl.set_index(['secid','date','exdate']).sort_index()
+    return surface_tbl
+
+def surface_lookup(secid,date,exdate=None):
+    '''Returns the contracts of secid quoted on date (and expiring on exdate
+    if given), reading only the monthly partition that contains date.'''
+    date=pd.Timestamp(date)
+    surface_tbl=load_surface(date.year,date.month)
+    if exdate==None:
+        key=(secid,date)
+    else:
+        key=(secid,date,pd.Timestamp(exdate))
+    return surface_tbl.loc[key:key]